@@ -17,6 +17,7 @@
 #       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 #       MA 02110-1301, USA.
 #
+import os
 from abc import ABC, abstractmethod
 from enum import Enum
 
@@ -29,6 +30,33 @@ class BuildType(Enum):
     TREE = 4
 
 
+# sdist file name endings, the ones
+# packaging.utils.parse_sdist_filename() accepts.
+SDIST_SUFFIXES = (".tar.gz", ".zip")
+
+# build artifact file suffix -> BuildType
+BUILD_SUFFIXES = {
+    ".whl": BuildType.WHEEL,
+    ".egg": BuildType.EGG,
+}
+
+
+def get_build_type(name, is_dir=False):
+    """Guess the kind of a build artifact from its file name.
+
+    Args:
+        name(str): the file name of the artifact.
+        is_dir(bool): True if the artifact is a directory.
+
+    Returns(BuildType): the artifact kind or None if unknown.
+    """
+    if is_dir:
+        return BuildType.TREE
+    if name.endswith(SDIST_SUFFIXES):
+        return BuildType.SDIST
+    return BUILD_SUFFIXES.get(os.path.splitext(name)[1])
+
+
 class Python517BuildBackend(ABC):
     # TODO: c extension build_ext
 
@@ -73,7 +101,7 @@ class Python517BuildBackend(ABC):
     def get_build_cmd(self):
         """Gets the arguments used to build a sdist.
 
-        Returns(list): a list containing the arguments to run.
+        Returns(tuple): a tuple containing the arguments to run.
         """
         pass
 
@@ -81,7 +109,7 @@ class Python517BuildBackend(ABC):
     def get_wheel_cmd(self):
         """Gets the arguments used to build a wheel.
 
-        Returns(list): a list containing the arguments to run.
+        Returns(tuple): a tuple containing the arguments to run.
         """
         pass
 
@@ -104,6 +132,12 @@ class Python517BuildBackend(ABC):
 class PypaBuildBackend(Python517BuildBackend):
     """PypaBuildBackend. """
 
+    BUILDDIR_NAME = "dist"
+    BUILD_CMD = (
+        "python", "-m", "build", "--sdist", "--outdir", BUILDDIR_NAME
+    )
+    WHEEL_CMD = ("python", "-m", "build", "--outdir", BUILDDIR_NAME)
+
     def get_display_name(self):
         return "Pypa Build"
 
@@ -111,22 +145,13 @@ class PypaBuildBackend(Python517BuildBackend):
         return [BuildType.SDIST]
 
     def get_builddir_name(self):
-        return "dist"
+        return self.BUILDDIR_NAME
 
     def get_build_cmd(self):
-        return ["python",
-                "-m",
-                "build",
-                "--sdist",
-                "--outdir",
-                self.get_builddir_name()]
+        return self.BUILD_CMD
 
     def get_wheel_cmd(self):
-        return ["python",
-                "-m",
-                "build",
-                "--outdir",
-                self.get_builddir_name()]
+        return self.WHEEL_CMD
 
     def has_isolation(self):
         return True
@@ -22,20 +22,49 @@
 #
 import os
 import sys
-import venv
+from functools import lru_cache
 from pathlib import Path
 
 import gi  # noqa
 from gi.repository import Gio, GLib, GObject, Ide
 
-import tomli
-from backends import BuildType, PypaBuildBackend
-from packaging.utils import parse_sdist_filename, parse_wheel_filename
+try:
+    import tomllib
+except ImportError:  # python < 3.11
+    import tomli as tomllib
+from backends import BuildType, PypaBuildBackend, get_build_type
 # from packaging.version import Version
-from stage import Python517BuildStage
+from stage import IO_ERROR_DOMAIN, Python517BuildStage
 
 _ = Ide.gettext
 
+# supported build-backend -> Python517BuildBackend class
+BUILD_BACKENDS = {
+    "setuptools.build_meta": PypaBuildBackend,
+}
+
+
+# build artifact file names are parsed again on each targets
+# request, they rarely change. packaging is only imported
+# once there is something to install.
+@lru_cache(maxsize=256)
+def parse_wheel_name(filename):
+    """Return the distribution name of a wheel file name."""
+    from packaging.utils import parse_wheel_filename
+    return parse_wheel_filename(filename)[0]
+
+
+@lru_cache(maxsize=256)
+def parse_sdist_name(filename):
+    """Return the distribution name of a sdist file name."""
+    from packaging.utils import parse_sdist_filename
+    return parse_sdist_filename(filename)[0]
+
+
+# parsed pyproject.toml files, path -> (mtime, size, dict),
+# a newer parse of a file replaces the stale one.
+_pyproject_cache = {}
+
 
 class Python517BuildSystemDiscovery(Ide.SimpleBuildSystemDiscovery):
     """SimpleBuildSystemDiscovery subclass.
@@ -76,11 +105,6 @@ class Python517BuildSystem(Ide.Object, Ide.BuildSystem, Gio.AsyncInitable):
     """
 
     project_file = GObject.Property(type=Gio.File)  # 'pyproject.toml'
-    backends = GObject.Property(
-        type=GLib.HashTable,
-        default={"setuptools.build_meta": PypaBuildBackend},
-        flags=GObject.ParamFlags.READABLE,
-    )
     # requires = GObject.Property(type=GLib.List, default=[])
     # backend_path = GObject.Property(type=GLib.List, default=[])
     frontend = GObject.Property(type=str, default="pip")
@@ -89,12 +113,29 @@ class Python517BuildSystem(Ide.Object, Ide.BuildSystem, Gio.AsyncInitable):
 
     # TODO: set wheel as installable
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._py_project = None
+        # BuildType -> names of the registered builds of this type
+        self._builds_by_kind = {kind: set() for kind in BuildType}
+
     def do_init_async(self, priority, cancel, callback, data=None):
         task = Gio.Task.new(self, cancel, callback)
         task.set_priority(priority)
-        # parse project_file
+        # parse project_file, unless it didn't change since last parsed
         project_file = self.get_pyproject_toml()
-        project_file.load_contents_async(
+        path = project_file.get_path()
+        try:
+            stat = os.stat(path)
+        except (OSError, TypeError):  # missing or not a local file
+            task.pyproject_key = None
+        else:
+            task.pyproject_key = (path, stat.st_mtime_ns, stat.st_size)
+            cached = _pyproject_cache.get(path)
+            if cached is not None and cached[:2] == task.pyproject_key[1:]:
+                self._apply_pyproject(cached[2], task)
+                return
+        project_file.load_bytes_async(
             cancel,
             self._on_load_pyproject_toml,
             task,
@@ -118,38 +159,40 @@ class Python517BuildSystem(Ide.Object, Ide.BuildSystem, Gio.AsyncInitable):
         """
 
         try:
-            _ok, contents, _etag = project_file.load_contents_finish(result)
+            contents, _etag = project_file.load_bytes_finish(result)
         except GLib.Error as err:  # IOError
             task.return_error(err)
             return
 
         try:
-            py_project = tomli.loads(contents.decode('utf-8'))
-        except tomli.TOMLDecodeError as err:  # Invalid toml file
+            py_project = tomllib.loads(contents.get_data().decode('utf-8'))
+        except tomllib.TOMLDecodeError as err:  # Invalid toml file
             task.return_error(err)
             return
+        if task.pyproject_key is not None:
+            path, mtime, size = task.pyproject_key
+            _pyproject_cache[path] = (mtime, size, py_project)
+        self._apply_pyproject(py_project, task)
 
-        if (
-            "build-system" not in py_project
-            or not isinstance(py_project["build-system"], dict)
-            or "build-backend" not in py_project["build-system"]
-            or not isinstance(
-                py_project["build-system"]["build-backend"], str
-            )
-        ):
+    def _apply_pyproject(self, py_project, task):
+        """Setup the build system from the parsed pyproject.toml."""
+        try:
+            build_backend = py_project["build-system"]["build-backend"]
+        except (KeyError, TypeError):
+            build_backend = None
+        if not isinstance(build_backend, str):
             # Not a PEP 517 python project
             task.return_error(
                 GLib.Error(
                     "Not a valid python PEP-517 build system",
-                    domain=GLib.quark_to_string(Gio.io_error_quark()),
+                    domain=IO_ERROR_DOMAIN,
                     code=Gio.IOErrorEnum.NOT_SUPPORTED,
                 )
             )
             return
 
-        _backend = self.props.backends.get(
-                    py_project["build-system"]["build-backend"]
-                )
+        self._py_project = py_project
+        _backend = BUILD_BACKENDS.get(build_backend)
         if _backend:
             self.props.build_backend = _backend()
 
@@ -160,9 +203,18 @@ class Python517BuildSystem(Ide.Object, Ide.BuildSystem, Gio.AsyncInitable):
 
         Returns(Gio.File): the 'pyproject.toml' file
         """
-        if self.props.project_file.get_basename() != 'pyproject.toml':
-            return self.props.project_file.get_child('pyproject.toml')
-        return self.props.project_file
+        project_file = self.props.project_file
+        if project_file.get_basename() != 'pyproject.toml':
+            return project_file.get_child('pyproject.toml')
+        return project_file
+
+    def get_pyproject_data(self):
+        """Return the parsed 'pyproject.toml' file.
+
+        Returns(dict): the pyproject.toml content or None
+                       if the build system is not initialized.
+        """
+        return self._py_project
 
     def do_get_project_version(self):
         """If the build system supports it, gets the project
@@ -170,8 +222,12 @@ class Python517BuildSystem(Ide.Object, Ide.BuildSystem, Gio.AsyncInitable):
 
         Returns(str): a string containing the project version
         """
-        # TODO: do_get_project_version()
-        return
+        project = (self._py_project or {}).get("project")
+        if isinstance(project, dict):
+            version = project.get("version")
+            if isinstance(version, str):
+                return version
+        return None
 
     def do_build_system_supports_language(self, language):
         """Say if this BuilSystem support 'language'.
@@ -193,10 +249,11 @@ class Python517BuildSystem(Ide.Object, Ide.BuildSystem, Gio.AsyncInitable):
 
         Returns(str): A path representing the build directory.
         """
-        if self.props.build_backend is None:
-            return self.get_context().ref_workdir().get_path()
+        build_backend = self.props.build_backend
         _wd = self.get_context().ref_workdir()
-        return self.props.build_backend.get_builddir(_wd).get_path()
+        if build_backend is None:
+            return _wd.get_path()
+        return build_backend.get_builddir(_wd).get_path()
 
     def do_get_id(self):
         return "python_517_build_system"
@@ -207,42 +264,24 @@ class Python517BuildSystem(Ide.Object, Ide.BuildSystem, Gio.AsyncInitable):
     def do_get_priority(self):
         return 500
 
-    def add_build(self, file):
+    def add_build(self, name, is_dir=False):
         """Register a build artifact.
 
         The artifact will be add only if its kind is supported
         by the Build Backend.
 
         Args:
-            file(pathlib.Path): the artifact to register.
+            name(str): the file name of the artifact to register.
+            is_dir(bool): True if the artifact is a directory.
         """
-        if(
-            file.is_dir() and BuildType.TREE
-            in self.props.build_backend.get_build_types()
-        ):
-            self.props.builds[file.name] = BuildType.TREE
-        elif(
-              file.suffix == ".egg" and BuildType.EGG
-              in self.props.build_backend.get_build_types()
-        ):
-            self.props.builds[file.name] = BuildType.EGG
-        elif(
-             file.suffix == ".whl" and BuildType.WHEEL
-             in self.props.build_backend.get_build_types()
-        ):
-            self.props.builds[file.name] = BuildType.WHEEL
-        # FIXME: valid suffixes for sdist?
-        elif(
-             file.suffix in [".gz", ".tar", ".zip"]
-             and BuildType.SDIST
-             in self.props.build_backend.get_build_types()
-        ):
-            self.props.builds[file.name] = BuildType.SDIST
-        elif(
-             BuildType.FILE in
-             self.props.build_backend.get_build_types()
-        ):
-            self.props.builds[file.name] = BuildType.FILE
+        build_types = self.props.build_backend.get_build_types()
+        kind = get_build_type(name, is_dir)
+        if kind not in build_types:
+            kind = BuildType.FILE
+            if kind not in build_types:
+                return
+        self.props.builds[name] = kind
+        self._builds_by_kind[kind].add(name)
 
     def clean_builds(self):
         """Unregister all build artifact.
@@ -251,6 +290,8 @@ class Python517BuildSystem(Ide.Object, Ide.BuildSystem, Gio.AsyncInitable):
         this only clear the artifact register dictionary.
         """
         self.props.builds.clear()
+        for names in self._builds_by_kind.values():
+            names.clear()
 
     def get_builds_installable(self):
         """Return a list of installable artifacts.
@@ -266,23 +307,21 @@ class Python517BuildSystem(Ide.Object, Ide.BuildSystem, Gio.AsyncInitable):
         b_inst = [(self.get_context().ref_workdir().get_path(),
                    BuildType.TREE,
                    "sources")]
-        installable = None
         name = "Unknown"
 
         # TODO: study priority of installable, what about egg and file
-        if BuildType.WHEEL in self.props.builds.values():
-            installable = BuildType.WHEEL
-        elif BuildType.SDIST in self.props.builds.values():
-            installable = BuildType.SDIST
-        elif BuildType.TREE in self.props.builds.values():
-            installable = BuildType.TREE
-        for file, kind in self.props.builds.items():
-            if kind is installable:
-                if kind is BuildType.WHEEL:
-                    name, _ver, _build, _tags = parse_wheel_filename(file)
-                elif kind is BuildType.SDIST:
-                    name, _ver = parse_sdist_filename(file)
-                b_inst.append((file, kind, name))
+        for kind in (BuildType.WHEEL, BuildType.SDIST, BuildType.TREE):
+            if self._builds_by_kind[kind]:
+                installable = kind
+                break
+        else:
+            return b_inst
+        for file in sorted(self._builds_by_kind[installable]):
+            if installable is BuildType.WHEEL:
+                name = parse_wheel_name(file)
+            elif installable is BuildType.SDIST:
+                name = parse_sdist_name(file)
+            b_inst.append((file, installable, name))
         return b_inst
 
     def get_virtual_env(self):
@@ -296,6 +335,8 @@ class Python517BuildSystem(Ide.Object, Ide.BuildSystem, Gio.AsyncInitable):
 
         Returns(pathlib.Path): A Path to a virtualenv or None.
         """
+        import venv
+
         context = self.get_context()
         config_manager = Ide.ConfigManager.from_context(context)
         config = config_manager.get_current()
@@ -340,8 +381,10 @@ class Python517PipelineAddin(Ide.Object, Ide.PipelineAddin):
         if not isinstance(build_system, Python517BuildSystem):
             return
 
-        # Build Phase
-        build_backend = build_system.get_property("build_backend")
+        # Build Phase, only with a supported build backend
+        build_backend = build_system.props.build_backend
+        if build_backend is None:
+            return
         build_stage = Python517BuildStage(build_backend)
         phase = Ide.PipelinePhase.BUILD
         stage_id = pipeline.attach(phase, 100, build_stage)
@@ -404,9 +447,10 @@ class Python517BuildTarget(Ide.Object, Ide.BuildTarget):
 
         Returns(str): containing the arguments to run the target.
         """
-        if self.props.virtual_env:
-            _argv = self.argv.copy()
-            _argv[0] = f"{self.props.virtual_env}/bin/{_argv[0]}"
+        virtual_env = self.props.virtual_env
+        if virtual_env:
+            _argv = list(self.argv)
+            _argv[0] = f"{virtual_env}/bin/{_argv[0]}"
             return _argv
         return self.argv
 
@@ -493,21 +537,22 @@ class Python517BuildTargetProvider(Ide.Object, Ide.BuildTargetProvider):
             task.return_error(
                 GLib.Error(
                     "Not a python 517 build system",
-                    domain=GLib.quark_to_string(Gio.io_error_quark()),
+                    domain=IO_ERROR_DOMAIN,
                     code=Gio.IOErrorEnum.NOT_SUPPORTED,
                 )
             )
             return
 
-        build_dir = build_system.props.build_backend.get_builddir_name()
+        build_backend = build_system.props.build_backend
+        build_dir = build_backend.get_builddir_name()
         installables = build_system.get_builds_installable()
         virtual_env = build_system.get_virtual_env()
         task.targets = []
 
         for file, kind, name in installables:
             if kind is BuildType.SDIST:
-                cmd = build_system.props.build_backend.get_wheel_cmd()
-                if build_system.props.build_backend.has_isolation():
+                cmd = build_backend.get_wheel_cmd()
+                if build_backend.has_isolation():
                     _venv = None
                 else:
                     _venv = virtual_env
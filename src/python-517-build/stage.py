@@ -17,20 +17,102 @@
 #       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 #       MA 02110-1301, USA.
 #
+import hashlib
+import os
 import shutil
+import threading
+import time
 from pathlib import Path
 
 import gi  # noqa
-from gi.repository import GLib, Ide
+from gi.repository import Gio, GLib, Ide
+
+from backends import get_build_type
 
 _ = Ide.gettext
 
+# GLib.Error domains
+IO_ERROR_DOMAIN = GLib.quark_to_string(Gio.io_error_quark())
+SPAWN_ERROR_DOMAIN = GLib.quark_to_string(GLib.spawn_error_quark())
+
+# name of the file holding the sources digest of the last build,
+# stored in the build directory.
+DIGEST_FILE = ".build_digest"
+# number of build directory entries read at once
+BUILDS_BATCH_SIZE = 64
+# top level directories never holding sources of the build
+SKIP_TOP_DIRS = frozenset(("build", "dist"))
+
+
+def sources_digest(srcdir, builddir):
+    """Return a digest of the project source tree.
+
+    The digest is built from the path, modification time and size
+    of every file, so the tree is only walked, no file is read.
+    Hidden, cache, egg-info and virtual env directories are skipped,
+    as are the build and dist directories at the project root.
+
+    Args:
+        srcdir(str): the project root directory.
+        builddir(str): the build directory, skipped too.
+
+    Returns(str): the hexadecimal digest.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    stack = [srcdir]
+    while stack:
+        path = stack.pop()
+        with os.scandir(path) as entries:
+            entries = sorted(entries, key=lambda _e: _e.name)
+        if path != srcdir and any(_e.name == "pyvenv.cfg" for _e in entries):
+            continue  # a virtual env inside the project
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if not (
+                    entry.name.startswith(".")
+                    or entry.name == "__pycache__"
+                    or (path == srcdir and entry.name in SKIP_TOP_DIRS)
+                    or entry.name.endswith(".egg-info")
+                    or entry.path == builddir
+                ):
+                    stack.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                stat = entry.stat(follow_symlinks=False)
+                digest.update(os.fsencode(os.path.relpath(entry.path, srcdir)))
+                digest.update(
+                    f"\0{stat.st_mtime_ns}\0{stat.st_size}\0".encode()
+                )
+    return digest.hexdigest()
+
+
+def remove_trees(paths):
+    """Delete the directory trees in paths, ignoring errors."""
+    for path in paths:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def has_build(build_dir, build_types):
+    """Return True if build_dir holds at least one
+    build artifact of a kind in build_types.
+    """
+    with os.scandir(build_dir) as entries:
+        return any(
+            get_build_type(_e.name, _e.is_dir()) in build_types
+            for _e in entries
+        )
+
 
 class Python517BuildStage(Ide.PipelineStage):
 
     def __init__(self, build_backend, *argv, **kwargs):
         super().__init__(*argv, **kwargs)
         self.backend = build_backend
+        # (digest file, sources digest) computed by the last query
+        self._digest = None
+        # the build command, resolved against the virtual env
+        # on first build and again after a clean.
+        self._argv = None
+        self._build_system = None
         self.set_name(
                 _(f"{build_backend.get_display_name()}: building project")
             )
@@ -45,23 +127,14 @@ class Python517BuildStage(Ide.PipelineStage):
         launcher = pipeline.create_launcher()
         launcher.set_cwd(srcdir)
 
-        context = pipeline.get_context()
-        build_system = Ide.BuildSystem.from_context(context)
-        _venv = None
-        if not self.backend.has_isolation():
-            _venv = build_system.get_virtual_env()
-
-        for i, arg in enumerate(self.backend.get_build_cmd()):
-            if i == 0 and _venv:
-                arg = f"{_venv}/bin/{arg}"
-            launcher.push_argv(arg)
+        argv = self._get_argv(self._get_build_system())
+        launcher.push_args(argv)
 
         task.connect("notify::completed", self._build_completed_cb)
         self.set_active(True)
         pipeline.attach_pty(launcher)
         self.log(
-            Ide.BuildLogStream.STDOUT, " ".join(self.backend.get_build_cmd()),
-            -1,
+            Ide.BuildLogStream.STDOUT, " ".join(argv), -1,
         )
 
         # launch the process
@@ -70,34 +143,97 @@ class Python517BuildStage(Ide.PipelineStage):
             task.return_error(
                 GLib.Error(
                     "build subprocess failed",
-                    domain=GLib.quark_to_string(GLib.spawn_error_quark()),
+                    domain=SPAWN_ERROR_DOMAIN,
                     code=GLib.SpawnError.FAILED,
                 )
             )
             return
         subprocess.wait_async(cancellable, self._wait_cb, task)
 
+    def _get_build_system(self):
+        if self._build_system is None:
+            self._build_system = Ide.BuildSystem.from_context(
+                self.get_context()
+            )
+        return self._build_system
+
+    def _get_argv(self, build_system):
+        if self._argv is None:
+            argv = self.backend.get_build_cmd()
+            if not self.backend.has_isolation():
+                _venv = build_system.get_virtual_env()
+                if _venv:
+                    argv = (f"{_venv}/bin/{argv[0]}", *argv[1:])
+            self._argv = argv
+        return self._argv
+
     def _wait_cb(self, subprocess, result, task):
         exit_status = subprocess.get_exit_status()
         if exit_status > 0:
             task.return_error(GLib.Error(
                     f"build subprocess exit with signal {exit_status}",
-                    domain=GLib.quark_to_string(GLib.spawn_error_quark()),
+                    domain=SPAWN_ERROR_DOMAIN,
                     code=GLib.SpawnError.FAILED,
                 )
             )
             return
+        if self._digest is not None:
+            digest_file, digest = self._digest
+            try:
+                digest_file.write_text(digest)
+            except OSError:
+                pass  # only means a rebuild next time
         task.return_boolean(True)
 
+    def _register_builds(self):
+        """Register the artifacts found in the build directory.
+
+        The directory is listed asynchronously,
+        by batches of BUILDS_BATCH_SIZE files.
+        """
+        build_system = self._get_build_system()
+        build_dir = Gio.File.new_for_path(build_system.get_builddir())
+        build_dir.enumerate_children_async(
+            "standard::name,standard::type",
+            Gio.FileQueryInfoFlags.NONE,
+            GLib.PRIORITY_LOW,
+            None,
+            self._on_enumerate_builds,
+            build_system,
+        )
+
+    def _on_enumerate_builds(self, build_dir, result, build_system):
+        try:
+            enumerator = build_dir.enumerate_children_finish(result)
+        except GLib.Error:  # nothing built yet
+            return
+        enumerator.next_files_async(
+            BUILDS_BATCH_SIZE, GLib.PRIORITY_LOW, None,
+            self._on_next_builds, build_system,
+        )
+
+    def _on_next_builds(self, enumerator, result, build_system):
+        try:
+            infos = enumerator.next_files_finish(result)
+        except GLib.Error:
+            infos = None
+        if not infos:
+            enumerator.close_async(GLib.PRIORITY_LOW, None, None)
+            return
+        for info in infos:
+            build_system.add_build(
+                info.get_name(),
+                info.get_file_type() == Gio.FileType.DIRECTORY,
+            )
+        enumerator.next_files_async(
+            BUILDS_BATCH_SIZE, GLib.PRIORITY_LOW, None,
+            self._on_next_builds, build_system,
+        )
+
     def _build_completed_cb(self, task, _pspec):
         # FIXME: build target ui not updated until collapsing
         # and expand target
-        context = self.get_context()
-        build_system = Ide.BuildSystem.from_context(context)
-        build_dir = Path(build_system.get_builddir())
-        if build_dir.is_dir():
-            for file in build_dir.iterdir():
-                build_system.add_build(file)
+        self._register_builds()
         self.set_active(False)
 
     def do_build_finish(self, task):
@@ -112,6 +248,7 @@ class Python517BuildStage(Ide.PipelineStage):
         task = Ide.Task.new(self, cancellable, callback)
         task.set_priority(GLib.PRIORITY_LOW)
         task.connect("notify::completed", self._clean_completed_cb)
+        self._argv = None
         self.set_active(True)
         self.log(
             Ide.BuildLogStream.STDOUT,
@@ -119,30 +256,39 @@ class Python517BuildStage(Ide.PipelineStage):
             -1,
         )
 
+        # Move the build directory out of the way, this is a single
+        # rename whatever its size, and delete it in a background thread.
         build_dir = Path(pipeline.get_builddir())
-        if build_dir.is_dir():
-            files = [child for child in build_dir.iterdir()]
-            for file in files:
-                if file.is_file():
-                    self.log(
-                        Ide.BuildLogStream.STDOUT, f"deleting {file.name}",
-                        -1,
-                    )
-                    file.unlink()
-                if file.is_dir():
-                    self.log(
-                        Ide.BuildLogStream.STDOUT,
-                        f"deleting {file.name} directory tree",
-                        -1,
-                    )
-                    shutil.rmtree(file, ignore_errors=True)
+        trash = build_dir.with_name(
+            f".{build_dir.name}.trash.{os.getpid()}.{time.time_ns()}"
+        )
+        try:
+            os.replace(build_dir, trash)
+        except FileNotFoundError:
+            pass  # nothing built
+        except OSError as err:
+            task.return_error(GLib.Error(
+                    f"failed to clean {build_dir}: {err}",
+                    domain=IO_ERROR_DOMAIN,
+                    code=Gio.IOErrorEnum.FAILED,
+                )
+            )
+            return
+        # also sweep trees left behind by a previous
+        # clean interrupted by gnome-builder exiting.
+        trashes = list(
+            build_dir.parent.glob(f".{build_dir.name}.trash.*")
+        )
+        if trashes:
+            threading.Thread(
+                target=remove_trees, args=(trashes,), daemon=True,
+            ).start()
         task.return_boolean(True)
 
     def _clean_completed_cb(self, task, _pspec):
         # FIXME: build target ui not updated until collapsing
         # and expand target
-        context = self.get_context()
-        build_system = Ide.BuildSystem.from_context(context)
+        build_system = self._get_build_system()
         build_system.clean_builds()
         self.set_active(False)
 
@@ -164,8 +310,45 @@ class Python517BuildStage(Ide.PipelineStage):
         operation has completed, and then call unpause()
         to resume execution of the stage.
         """
-        # This will run on every request to run the phase
-        self.set_completed(False)
+        # This will run on every request to run the phase,
+        # skip the build if the sources didn't change since
+        # the last successful one and its artifacts are still
+        # there. Walking the sources may take a while, do it
+        # in a thread while the stage is paused.
+        self.pause()
+        threading.Thread(
+            target=self._query_thread,
+            args=(pipeline.get_srcdir(), pipeline.get_builddir()),
+            daemon=True,
+        ).start()
+
+    def _query_thread(self, srcdir, build_dir):
+        # _query_done() must always be scheduled, the stage
+        # stays paused until it runs.
+        digest = None
+        completed = False
+        try:
+            digest_file = Path(build_dir) / DIGEST_FILE
+            digest = (digest_file, sources_digest(srcdir, build_dir))
+            completed = (
+                digest_file.read_text() == digest[1]
+                and has_build(build_dir, self.backend.get_build_types())
+            )
+        except OSError:  # never built
+            pass
+        except Exception:
+            digest = None
+            completed = False
+        finally:
+            GLib.idle_add(self._query_done, digest, completed)
+
+    def _query_done(self, digest, completed):
+        self._digest = digest
+        if completed:
+            self._register_builds()
+        self.set_completed(completed)
+        self.unpause()
+        return GLib.SOURCE_REMOVE
 
     def do_chain(self, _next):
         """
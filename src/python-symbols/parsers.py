@@ -19,35 +19,47 @@
 #       MA 02110-1301, USA.
 #
 import ast
+import functools
 import logging
-import os
-import pickle
+import marshal
+import operator
+import sys
 from abc import ABC, abstractmethod
-from collections import namedtuple
-from enum import Flag
-from pathlib import Path
-
-import gi  # noqa
-from gi.repository import Gio, GLib, Ide
+from enum import Flag, IntEnum
+from typing import List, Optional, Tuple, Type
 
 import parso
 
+# This module is imported by the worker processes, a plain
+# interpreter without the gi Ide bindings, keep it free of them.
+# The plugin sets the log level from the Ide verbosity.
 log = logging.getLogger(__name__)
-log.setLevel(Ide.log_get_verbosity() * 10)
-handler = logging.StreamHandler()
-formatter = logging.Formatter(
-    '%(asctime)-13s %(name)+49s %(levelname)+8s: %(message)s',
-    '%H:%M:%S.%04d'
-)
-handler.setFormatter(formatter)
-log.addHandler(handler)
+# the plugin may be loaded again in the same
+# process, don't stack up handlers.
+if not log.handlers:
+    handler = logging.StreamHandler()
+    formatter = logging.Formatter(
+        '%(asctime)-13s %(name)+49s %(levelname)+8s: %(message)s',
+        '%H:%M:%S.%04d'
+    )
+    handler.setFormatter(formatter)
+    log.addHandler(handler)
 
 
 def debug(func):
-    """decorator to log function call."""
+    """decorator to log function call.
+
+    func is returned untouched if debug logging
+    is disabled when the module is loaded.
+    """
+    if not log.isEnabledFor(logging.DEBUG):
+        return func
+
+    @functools.wraps(func)
     def _func(*args, **kwargs):
-        log.debug(f"{func.__qualname__}()")
-        func(*args, **kwargs)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("%s()", func.__qualname__)
+        return func(*args, **kwargs)
     return _func
 
 
@@ -62,29 +74,36 @@ class SYNTAX_KIND(Flag):
     NONE = 0
 
 
+class SYMBOL_KIND(IntEnum):
+    """Symbol kinds of the parsers, mapped by name
+    to Ide.SymbolKind by the plugin.
+    """
+    PACKAGE = 1
+    CLASS = 2
+    FUNCTION = 3
+    METHOD = 4
+    CONSTRUCTOR = 5
+    PROPERTY = 6
+    VARIABLE = 7
+
+
 class SyntaxNode(ABC):
     """SyntaxNode"""
 
-    def __new__(cls, source, *args, parent=None, **kwargs):
-        instance = super().__new__(cls)
-        if isinstance(source, Gio.File):
-            instance.source = cls._source_from_file(source, **kwargs)
-            instance._is_root = True
-        else:
-            instance.source = source
-            instance._is_root = False
-        return instance
-
     @abstractmethod
     def __init__(self, source, *args, parent=None, **kwargs):
+        self.source = source
         self.parent = parent
+        self._is_root = parent is None
         self._kind = None
         self._children = []
 
-    @classmethod
+    @staticmethod
     @abstractmethod
-    def _source_from_file(cls, **kwargs):  # noqa
-        pass
+    def parse_file(path):
+        """Parse the python sources file located at 'path' and
+        return the root of its syntax tree.
+        """
 
     @abstractmethod
     def iter_child_nodes(self):
@@ -120,7 +139,7 @@ class ParsoSyntaxNode(SyntaxNode):
         super().__init__(*args, **kwargs)
 
         if self.source.type == 'file_input':
-            self._kind = Ide.SymbolKind.PACKAGE
+            self._kind = SYMBOL_KIND.PACKAGE
             self._name = "module"
             self._line, self._col = (0, 0)
             self._children = list(self.source.children)
@@ -131,16 +150,16 @@ class ParsoSyntaxNode(SyntaxNode):
             self.source = self.source.children[-1]
 
         if self.source.type in ('classdef', 'cclassdef'):
-            self._kind = Ide.SymbolKind.CLASS
+            self._kind = SYMBOL_KIND.CLASS
             self._name = self.source.name.value
             self._line, self._col = self.source.start_pos
             self._children = list(self.source.get_suite().children)
 
         elif self.source.type in ('funcdef', 'cfuncdef'):
             self._kind = (
-                Ide.SymbolKind.METHOD
-                if self.parent._kind is Ide.SymbolKind.CLASS
-                else Ide.SymbolKind.FUNCTION
+                SYMBOL_KIND.METHOD
+                if self.parent._kind is SYMBOL_KIND.CLASS
+                else SYMBOL_KIND.FUNCTION
             )
             self._name = self.source.name.value
             self._line, self._col = self.source.start_pos
@@ -150,7 +169,7 @@ class ParsoSyntaxNode(SyntaxNode):
         elif self.source.type == 'simple_stmt':
             self.source = self.source.children[0]
             if self.source.type in ('import_names', 'import_from'):
-                self._kind = Ide.SymbolKind.PACKAGE
+                self._kind = SYMBOL_KIND.PACKAGE
                 self._name = ", ".join(
                     [n.value for n in self.source.get_defined_names()]
                 )
@@ -158,17 +177,17 @@ class ParsoSyntaxNode(SyntaxNode):
 
         # TODO: module variable & class variable
 
-    @classmethod
-    def _source_from_file(cls, file, **kwargs):  # noqa
+    @staticmethod
+    def parse_file(path):
+        # unchanged files are served by the plugin's tree cache,
+        # parso's own cache would only miss and pickle the tree.
         try:
-            with open(file.get_path(), "r") as _file:
-                data = _file.read()
-            source = parso.parse(data)
+            source = parso.parse(path=path, cache=False)
         except IOError as err:
             raise SyntaxNodeError(f"Failed to open stream: {err}")
         except Exception as err:
             raise SyntaxNodeError(f"Unexpected error: {err}")
-        return source  # noqa
+        return source
 
     def iter_child_nodes(self):
         for parso_node in self._children:
@@ -178,152 +197,147 @@ class ParsoSyntaxNode(SyntaxNode):
         return max(self._line - 1, 0)
 
     def dump(self):
-        dump = str(self.source)
-        dump += "\n"
-        if not isinstance(self.source, parso.tree.BaseNode):
-            return dump
-        for child in self.source.children:
-            dump = self._dump_node(child, dump, 1)
-        return dump
+        lines = [str(self.source)]
+        if isinstance(self.source, parso.tree.BaseNode):
+            for child in self.source.children:
+                self._dump_node(child, lines, 1)
+        lines.append("")
+        return "\n".join(lines)
 
     @classmethod
-    def _dump_node(cls, node, dump="", indent=0):
-        _ind = "".join(["  "] * indent)
-        dump += f"{_ind}{str(node)}\n"
+    def _dump_node(cls, node, lines, indent=0):
+        lines.append(f"{'  ' * indent}{node}")
         indent += 1
         if not isinstance(node, parso.tree.BaseNode):
-            return dump
+            return
         for child in node.children:
-            dump = cls._dump_node(child, dump, indent)
-        return dump
+            cls._dump_node(child, lines, indent)
 
 
-EXPORT_VARIABLE_SCOPE = [Ide.SymbolKind.PACKAGE, Ide.SymbolKind.CLASS]
+_PACKAGE = SYMBOL_KIND.PACKAGE
+_CLASS = SYMBOL_KIND.CLASS
+_FUNCTION = SYMBOL_KIND.FUNCTION
+_METHOD = SYMBOL_KIND.METHOD
+_CONSTRUCTOR = SYMBOL_KIND.CONSTRUCTOR
+_PROPERTY = SYMBOL_KIND.PROPERTY
+_VARIABLE = SYMBOL_KIND.VARIABLE
 
+EXPORT_VARIABLE_SCOPE = [_PACKAGE, _CLASS]
 
-def _get_func_def(ast_node, parent_syntax_node):
-    decorator_list = []
-    for _d in ast_node.decorator_list:
-        if isinstance(_d, ast.Name):
-            decorator_list.append(_d.id)
-        elif isinstance(_d, ast.Call):
-            decorator_list.append(_d.func.id)
-    if parent_syntax_node.get_kind() == Ide.SymbolKind.CLASS:
-        if ast_node.name == "__new__":
-            return Ide.SymbolKind.CONSTRUCTOR
-        elif "property" in decorator_list:
-            return Ide.SymbolKind.PROPERTY
-        else:
-            return Ide.SymbolKind.METHOD
-    return Ide.SymbolKind.FUNCTION
+_AST_NAME = ast.Name
+_AST_CALL = ast.Call
+_AST_TUPLE = ast.Tuple
 
 
-def _get_assign_def(ast_node, parent_syntax_node):
+def _get_func_def(
+    ast_node: ast.FunctionDef, parent_syntax_node: SyntaxNode
+) -> SYMBOL_KIND:
+    if parent_syntax_node.get_kind() != _CLASS:
+        return _FUNCTION
+    if ast_node.name == "__new__":
+        return _CONSTRUCTOR
+    for _d in ast_node.decorator_list:
+        _type = type(_d)
+        if _type is _AST_CALL:
+            _d = _d.func
+            _type = type(_d)
+        if _type is _AST_NAME and _d.id == "property":
+            return _PROPERTY
+    return _METHOD
+
+
+def _get_assign_def(
+    ast_node: ast.Assign, parent_syntax_node: SyntaxNode
+) -> Optional[SYMBOL_KIND]:
     if (
         parent_syntax_node.get_kind() in
         EXPORT_VARIABLE_SCOPE
     ):
-        return Ide.SymbolKind.VARIABLE
+        return _VARIABLE
     return None
 
 
-def _get_assign_name(ast_node):
-    if isinstance(ast_node.targets[0], ast.Name):
-        return ast_node.targets[0].id
-    elif isinstance(ast_node.targets[0], ast.Tuple):
-        return ast_node.targets[0].elts[0].id
-    else:
-        return "UNDEFINED"
+def _get_assign_name(ast_node: ast.Assign) -> str:
+    target = ast_node.targets[0]
+    if type(target) is _AST_TUPLE and target.elts:
+        target = target.elts[0]
+    if type(target) is _AST_NAME:
+        return target.id
+    return "UNDEFINED"
 
 
-Desc = namedtuple("Desc", ["kind", "name"])
+_name_attr = operator.attrgetter("name")
 
 
 class AstSyntaxNode(SyntaxNode):
     """AstSyntaxNode"""
 
+    # ast type -> (kind_fn, name_fn)
     AST_BASE_STMT = {
-        ast.FunctionDef: Desc(
-            kind=_get_func_def,
-            name=lambda _n: _n.name,
-        ),
-        ast.AsyncFunctionDef: Desc(
-            kind=_get_func_def,
-            name=lambda _n: _n.name,
-        ),
-        ast.ClassDef: Desc(
-            kind=lambda _n, _p: Ide.SymbolKind.CLASS,
-            name=lambda _n: _n.name,
-        ),
+        ast.FunctionDef: (_get_func_def, _name_attr),
+        ast.AsyncFunctionDef: (_get_func_def, _name_attr),
+        ast.ClassDef: (lambda _n, _p: _CLASS, _name_attr),
     }
 
     AST_IMPT_STMT = {
-        ast.Import: Desc(
-            kind=lambda _n, _p: Ide.SymbolKind.PACKAGE,
-            name=lambda _n: ", ".join([_a.name for _a in _n.names]),
+        ast.Import: (
+            lambda _n, _p: _PACKAGE,
+            lambda _n: ", ".join([_a.name for _a in _n.names]),
         ),
-        ast.ImportFrom: Desc(
-            kind=lambda _n, _p: Ide.SymbolKind.PACKAGE,
-            name=lambda _n: ", ".join([_a.name for _a in _n.names]),
+        ast.ImportFrom: (
+            lambda _n, _p: _PACKAGE,
+            lambda _n: ", ".join([_a.name for _a in _n.names]),
         ),
     }
 
     AST_VAR_STMT = {
-        ast.Assign: Desc(
-            kind=_get_assign_def,
-            name=_get_assign_name,
-        ),
+        ast.Assign: (_get_assign_def, _get_assign_name),
     }
 
     AST_STMT = {}
 
+    # Only those nodes may hold symbols in their body,
+    # any other statement is a leaf of the symbol tree.
+    AST_SCOPE = frozenset(
+        (ast.Module, ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+    )
+
     @debug
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self._children = []
-        for ast_node in ast.iter_child_nodes(self.source):
-            self._children.append(ast_node)
+        if self._is_root:
+            self._set_exports(**kwargs)
+
+        if type(self.source) in self.AST_SCOPE:
+            self._children = self.source.body
+        else:
+            self._children = []
 
-        desc = self.AST_STMT.get(type(self.source), None)
+        desc = self.AST_STMT.get(type(self.source))
         if desc:
-            self._kind = desc.kind(self.source, self.parent)
-            self._name = desc.name(self.source)
+            kind_fn, name_fn = desc
+            self._kind = kind_fn(self.source, self.parent)
+            self._name = name_fn(self.source)
             self._line = self.source.lineno - 1
             self._col = self.source.col_offset
 
-    @classmethod
-    def _source_from_file(cls, file, **kwargs):
-        # context = kwargs.get("context", None)
-        # if context is None:
-        #     raise AttributeError("need an Ide.Context")
-        # srcdir = context.ref_workdir().get_path()
-        launcher = Ide.SubprocessLauncher()
-        launcher.set_flags(Gio.SubprocessFlags.STDOUT_PIPE)
-        # launcher.set_cwd(srcdir)
-        launcher.push_args(['sources_inspect.py', file.get_path()])
-
+    @staticmethod
+    def parse_file(path):
         try:
-            subprocess = launcher.spawn()
-            success, stdout, stderr = subprocess.communicate_utf8(None, None)
-            if not success:
-                raise SyntaxNodeError('Failed to run sources_inspect.py')
-            tmp_path = Path(stdout)
-            with open(tmp_path, mode='rb') as _file:
+            with open(path, mode='rb') as _file:
                 data = _file.read()
-            ast_tree = pickle.loads(data)
-            os.unlink(tmp_path)
-
-        except GLib.Error as err:
-            raise SyntaxNodeError(err)
+            ast_tree = compile(
+                data, path, "exec",
+                flags=ast.PyCF_ONLY_AST, dont_inherit=True
+            )
         except OSError as err:
             raise SyntaxNodeError(f"Failed to open stream: {err}")
-        except pickle.UnpicklingError as err:
-            raise SyntaxNodeError(f"Failed to unpickle stream: {err}")
-
-        if not isinstance(ast_tree, ast.Module):
-            raise SyntaxNodeError("Failed to unpickle to an ast.Module")
-        ast.fix_missing_locations(ast_tree)
+        except (SyntaxError, ValueError) as err:
+            raise SyntaxNodeError(f"Failed to parse source: {err}")
+        return ast_tree
 
+    @classmethod
+    def _set_exports(cls, **kwargs):
         global EXPORT_VARIABLE_SCOPE
         EXPORT_VARIABLE_SCOPE.clear()
         cls.AST_STMT = dict(cls.AST_BASE_STMT)
@@ -331,29 +345,82 @@ class AstSyntaxNode(SyntaxNode):
             cls.AST_STMT |= cls.AST_IMPT_STMT
         if kwargs.get("xprt_mod_var"):
             cls.AST_STMT |= cls.AST_VAR_STMT
-            EXPORT_VARIABLE_SCOPE.append(Ide.SymbolKind.PACKAGE)
+            EXPORT_VARIABLE_SCOPE.append(_PACKAGE)
         if kwargs.get("xprt_class_var"):
             cls.AST_STMT |= cls.AST_VAR_STMT
-            EXPORT_VARIABLE_SCOPE.append(Ide.SymbolKind.CLASS)
-        return ast_tree
+            EXPORT_VARIABLE_SCOPE.append(_CLASS)
 
     def dump(self):
-        dump = ""
+        lines = []
         for node in ast.walk(self.source):
             _type = type(node)
-            expr = "expr" if issubclass(_type, ast.expr) else ""
-            stmt = "stmt" if issubclass(_type, ast.stmt) else ""
-            line = node.lineno if hasattr(node, "lineno") else ""
-            name = node.name if hasattr(node, "name") else ""
-            dump += f"{type(node)}({expr},{stmt})"
+            expr = "expr" if isinstance(node, ast.expr) else ""
+            stmt = "stmt" if isinstance(node, ast.stmt) else ""
+            line = f"{_type}({expr},{stmt})"
+            name = getattr(node, "name", "")
             if name:
-                dump += f" name:{name}"
-            if line:
-                dump += f" line:{line}"
-            dump += "\n"
-        return dump
+                line += f" name:{name}"
+            lineno = getattr(node, "lineno", "")
+            if lineno:
+                line += f" line:{lineno}"
+            lines.append(line)
+        lines.append("")
+        return "\n".join(lines)
 
     def iter_child_nodes(self):
+        # statements without a symbol kind are left out of the
+        # symbol tree, don't wrap them in a syntax node at all.
+        stmt = self.AST_STMT
         for ast_node in self._children:
-            yield AstSyntaxNode(ast_node, parent=self)
-
+            if type(ast_node) in stmt:
+                yield AstSyntaxNode(ast_node, parent=self)
+
+
+# (line, col, kind, name, depth)
+SymbolRecord = Tuple[int, int, int, str, int]
+
+
+def parse_symbols(
+    syntax_parser: Type[SyntaxNode], path: str, **kwargs
+) -> List[SymbolRecord]:
+    """Parse the python sources file located at 'path' with the
+    SyntaxNode class 'syntax_parser' and return its symbols as a
+    flat list of (line, col, kind, name, depth) records in preorder.
+
+    kind is the int value of a SYMBOL_KIND and depth the nesting
+    level of the symbol, 0 for top level symbols. This is run in
+    a worker process, only those records are sent back to the plugin.
+    """
+    syntax_tree = syntax_parser(syntax_parser.parse_file(path), **kwargs)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(syntax_tree.dump())
+    records: List[SymbolRecord] = []
+    # iterative preorder walk over a stack of child node generators,
+    # the depth of a node is the number of generators above the root's.
+    stack = [syntax_tree.iter_child_nodes()]
+    while stack:
+        syntax_node = next(stack[-1], None)
+        if syntax_node is None:
+            stack.pop()
+            continue
+        kind = syntax_node.get_kind()
+        if kind:
+            records.append((
+                syntax_node.get_line(),
+                syntax_node.get_col(),
+                int(kind),
+                sys.intern(syntax_node.get_name()),
+                len(stack) - 1,
+            ))
+            stack.append(syntax_node.iter_child_nodes())
+    return records
+
+
+def dump_symbols(
+    syntax_parser: Type[SyntaxNode], path: str, **kwargs
+) -> bytes:
+    """Same as parse_symbols() but returns the records serialized by
+    marshal, a lot cheaper than pickle for such plain tuples. Used to
+    send records back from a worker process.
+    """
+    return marshal.dumps(parse_symbols(syntax_parser, path, **kwargs))
@@ -18,72 +18,319 @@
 #       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 #       MA 02110-1301, USA.
 #
+import functools
 import logging
-import threading
+import marshal
+import multiprocessing
+import os
+import shutil
+import sys
+from array import array
+from collections import OrderedDict
 from collections.abc import Callable
+from concurrent.futures import (
+    Future, ProcessPoolExecutor, ThreadPoolExecutor
+)
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 from typing import Any, List, Optional
 
 import gi  # noqa
 from gi.repository import Gio, GLib, GObject, Ide
 
-from parsers import AstSyntaxNode, ParsoSyntaxNode, SyntaxNode, SyntaxNodeError
-from symbols_preferences import PythonSymbolsPreferencesAddin  # noqa
-
-SYMBOL_PARAM_FLAGS = flags = (
-    GObject.ParamFlags.CONSTRUCT_ONLY | GObject.ParamFlags.READWRITE
+from parsers import (
+    SYMBOL_KIND, AstSyntaxNode, ParsoSyntaxNode, SyntaxNodeError,
+    dump_symbols, parse_symbols
 )
-
+from symbols_preferences import PythonSymbolsPreferencesAddin  # noqa
 
 log = logging.getLogger(__name__)
 log.setLevel(Ide.log_get_verbosity() * 10)
-handler = logging.StreamHandler()
-formatter = logging.Formatter(
-    '%(asctime)-13s %(name)+49s %(levelname)+8s: %(message)s',
-    '%H:%M:%S.%04d'
-)
-handler.setFormatter(formatter)
-log.addHandler(handler)
+logging.getLogger("parsers").setLevel(log.level)
+# the plugin may be loaded again in the same
+# process, don't stack up handlers.
+if not log.handlers:
+    handler = logging.StreamHandler()
+    formatter = logging.Formatter(
+        '%(asctime)-13s %(name)+49s %(levelname)+8s: %(message)s',
+        '%H:%M:%S.%04d'
+    )
+    handler.setFormatter(formatter)
+    log.addHandler(handler)
+
+
+# Parsing is CPU bound and may crash the interpreter on
+# sufficiently large/complex sources, so do it in worker processes,
+# or in a background thread if the user opt out of multiprocessing.
+_parse_pool = None
+_parse_thread = None
+# number of loaded PythonSymbolProvider
+_live_providers = 0
+
+# Workers are fresh interpreters, not forks of gnome-builder: they
+# don't inherit its threads, locks or file descriptors. python is
+# embedded there, sys.executable is not an interpreter, so start the
+# one matching the embedded python, they share the same sys.path.
+# parsers.py is imported by the workers, it doesn't use the gi bindings.
+PARSE_WORKERS = 2
+
+
+@functools.lru_cache(maxsize=None)
+def get_python_executable() -> Optional[str]:
+    """Returns the path of a python interpreter of the same version
+    as the one embedded in gnome-builder, or None if there is none.
+    """
+    name = f"python{sys.version_info.major}.{sys.version_info.minor}"
+    for path in (
+        os.path.join(sys.base_exec_prefix, "bin", name),
+        shutil.which(name),
+    ):
+        if path and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def get_parse_pool() -> Optional[ProcessPoolExecutor]:
+    """Returns the process pool used to parse python sources,
+    or None if no python interpreter could run the workers.
+    """
+    global _parse_pool
+    if _parse_pool is None:
+        executable = get_python_executable()
+        if executable is None:
+            return None
+        context = multiprocessing.get_context("spawn")
+        context.set_executable(executable)
+        _parse_pool = ProcessPoolExecutor(
+            max_workers=PARSE_WORKERS, mp_context=context
+        )
+    return _parse_pool
+
+
+def reset_parse_pool() -> None:
+    """Shutdown the parse pool (because it's broken or not needed
+    anymore), a new one will be created on demand.
+    """
+    global _parse_pool
+    if _parse_pool is not None:
+        _parse_pool.shutdown(wait=False)
+        _parse_pool = None
+
+
+def get_parse_thread() -> ThreadPoolExecutor:
+    """Returns the single thread executor used to parse
+    python sources in the gnome-builder process.
+    """
+    global _parse_thread
+    if _parse_thread is None:
+        _parse_thread = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="python-symbols"
+        )
+    return _parse_thread
+
+
+# Small sources are parsed faster than they could be sent to
+# and back from a worker process, keep them in process.
+INPROCESS_MAX_SIZE = 32 * 1024
+
+
+def submit_parse(multiprocess: bool, size: int, *args, **kwargs) -> Future:
+    """Submit parse_symbols(*args, **kwargs) for a sources file of
+    'size' bytes. The future's result is the list of symbol records,
+    marshaled as bytes when it comes from a worker process.
+    """
+    if multiprocess and size > INPROCESS_MAX_SIZE:
+        pool = get_parse_pool()
+        if pool is not None:
+            return pool.submit(dump_symbols, *args, **kwargs)
+    return get_parse_thread().submit(parse_symbols, *args, **kwargs)
+
+
+def invoke_in_context(context: GLib.MainContext, func, *args) -> None:
+    """Call func(*args) once from the main loop running 'context',
+    this could be called from any thread.
+    """
+    source = GLib.Idle()
+    source.set_callback(lambda *_: func(*args))
+    source.attach(context)
+
+
+# Symbol trees of the last requested files shared by all providers,
+# path -> (cache key, PythonSymbolTree). Only used from the main loop.
+TREE_CACHE_SIZE = 256
+_tree_cache = OrderedDict()
+
+
+def get_cached_tree(path: str, key: tuple) -> Optional['PythonSymbolTree']:
+    """Returns the cached tree of path if it was built for key."""
+    cached = _tree_cache.get(path)
+    if cached is not None and cached[0] == key:
+        _tree_cache.move_to_end(path)
+        return cached[1]
+    return None
+
+
+def cache_tree(path: str, key: tuple, tree: 'PythonSymbolTree') -> None:
+    """Cache tree as the symbol tree of path built for key."""
+    _tree_cache[path] = (key, tree)
+    _tree_cache.move_to_end(path)
+    if len(_tree_cache) > TREE_CACHE_SIZE:
+        _tree_cache.popitem(last=False)
+
+
+# One Gio.Settings for all providers, its values are read
+# once and read again only after a key changed.
+SETTINGS_SCHEMA = "org.gnome.builder.plugins.python-symbols"
+_settings = None
+_settings_values = None
+
+
+def _invalidate_settings(*args) -> None:
+    global _settings_values
+    _settings_values = None
+
+
+def get_symbol_settings() -> tuple:
+    """Returns the (parser, exports, multiprocess) tuple read
+    from the plugin settings. Only used from the main loop.
+    """
+    global _settings, _settings_values
+    if _settings is None:
+        _settings = Gio.Settings(schema=SETTINGS_SCHEMA)
+        _settings.connect("changed", _invalidate_settings)
+    if _settings_values is None:
+        exports = dict(
+            xprt_impts=_settings.get_boolean("export-imports"),
+            xprt_mod_var=_settings.get_boolean("export-modules-variables"),
+            xprt_cls_var=_settings.get_boolean("export-class-variables"),
+        )
+        _settings_values = (
+            _settings.get_string("symbol-parser"),
+            exports,
+            _settings.get_boolean("multiprocess-parsing"),
+        )
+    return _settings_values
+
+
+SYNTAX_PARSERS = {
+    "ast": AstSyntaxNode,
+    "parso": ParsoSyntaxNode,
+}
 
 
 def debug(func):
-    """decorator to log function call."""
+    """decorator to log function call.
+
+    func is returned untouched if debug logging
+    is disabled when the module is loaded.
+    """
+    if not log.isEnabledFor(logging.DEBUG):
+        return func
+
+    @functools.wraps(func)
     def _func(*args, **kwargs):
-        log.debug(f"{func.__qualname__}()")
-        func(*args, **kwargs)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("%s()", func.__qualname__)
+        return func(*args, **kwargs)
     return _func
 
 
-class PythonSymbolNode(Ide.SymbolNode):
-    __gtype_name__ = 'PythonSymbolNode'
-    file = GObject.Property(type=Gio.File, flags=SYMBOL_PARAM_FLAGS)
-    line = GObject.Property(type=int, flags=SYMBOL_PARAM_FLAGS)
-    col = GObject.Property(type=int, flags=SYMBOL_PARAM_FLAGS)
-    children = GObject.Property(type=object, flags=GObject.ParamFlags.READWRITE)
+def format_symbol(
+    line: int, col: int, kind: int, name: str, depth: int
+) -> str:
+    """Returns the debug representation of a symbol, indented by depth."""
+    return (
+        f"{'   ' * depth}PythonSymbolNode(line={line}, col={col}, "
+        f"name={name}, kind={Ide.SymbolKind(kind).value_name})"
+    )
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, children=[], **kwargs)
+
+# SYMBOL_KIND value -> Ide.SymbolKind value
+SYMBOL_KINDS = {
+    _kind.value: int(getattr(Ide.SymbolKind, _kind.name))
+    for _kind in SYMBOL_KIND
+}
+
+
+class SymbolStore:
+    """Symbols of a tree stored column wise, in preorder.
+
+    A symbol is only an index in those arrays, creating a GObject
+    for each symbol is expensive and libide only request a few of
+    them, the matching PythonSymbolNode is created on demand.
+    """
+    __slots__ = ('lines', 'cols', 'kinds', 'names', 'depths', 'ends')
+
+    def __init__(self, records: List[tuple]):
+        lines, cols, kinds, names, depths = (
+            zip(*records) if records else ((),) * 5
+        )
+        self.lines = array('i', lines)
+        self.cols = array('i', cols)
+        self.kinds = array('i', map(SYMBOL_KINDS.__getitem__, kinds))
+        self.names = list(map(sys.intern, names))
+        self.depths = array('i', depths)
+
+        # ends[index] is the index following
+        # the last descendant of symbol index.
+        size = len(self.names)
+        ends = self.ends = array('i', [size]) * size
+        stack = []
+        for index, depth in enumerate(self.depths):
+            while stack and self.depths[stack[-1]] >= depth:
+                ends[stack.pop()] = index
+            stack.append(index)
 
     def __len__(self) -> int:
-        return len(self.children)
+        return len(self.names)
 
-    def __bool__(self) -> bool:
-        return True
+    def get_children(self, index: int) -> List[int]:
+        """Returns the indexes of the children of symbol index,
+        or of the top level symbols if index is -1.
+        """
+        ends = self.ends
+        end = len(self.names) if index < 0 else ends[index]
+        children = []
+        child = index + 1
+        while child < end:
+            children.append(child)
+            child = ends[child]
+        return children
+
+    def dump(self, indent: int = 0) -> List[str]:
+        return [
+            format_symbol(line, col, kind, name, indent + depth)
+            for line, col, kind, name, depth in zip(
+                self.lines, self.cols, self.kinds, self.names, self.depths
+            )
+        ]
 
-    def __getitem__(self, index: int) -> Optional['PythonSymbolNode']:
-        try:
-            return self.children[index]
-        except IndexError:
-            return None
 
-    def __iter__(self):
-        return iter(self.children)
+class PythonSymbolNode(Ide.SymbolNode):
+    __gtype_name__ = 'PythonSymbolNode'
+
+    def __init__(
+        self,
+        line: int = 0,
+        col: int = 0,
+        kind: Ide.SymbolKind = Ide.SymbolKind.NONE,
+        name: str = "",
+        file: Optional[Gio.File] = None,
+        index: int = -1,
+    ):
+        super().__init__(name=name, kind=kind)
+        # libide only reads name and kind through GObject,
+        # the rest are plain attributes, cheaper to set and read.
+        # All nodes of a tree share the same Gio.File,
+        # index is the node's symbol in the tree SymbolStore.
+        self.line = line
+        self.col = col
+        self.file = file
+        self.index = index
 
     def __repr__(self) -> str:
-        return (
-            f"PythonSymbolNode(line={self.line}, col={self.col}, "
-            f"name={self.props.name}, kind={(self.props.kind.value_name)}, "
-            # f"file={self.file.get_path()})"
+        return format_symbol(
+            self.line, self.col, self.props.kind, self.props.name, 0
         )
 
     def do_get_location_async(
@@ -103,89 +350,35 @@ class PythonSymbolNode(Ide.SymbolNode):
             return Ide.Location.new(self.file, self.line, self.col)
         return None
 
-    def append(self, node: 'PythonSymbolNode') -> None:
-        self.children.append(node)
-
-    def dump(self, parent_dump="", indent=0):
-        _indent = "".join(["   "] * indent)
-        dump = f"{parent_dump}\n{_indent}{self.__repr__()}"
-        indent += 1
-        for child in self:
-            dump = child.dump(dump, indent)
-        return dump
-
 
 class PythonSymbolTree(GObject.Object, Ide.SymbolTree):
 
     @debug
-    def __init__(self, file: Gio.File):
-        """Visit the ast.Module ast_module recursivly
-        and return the tree's root as a PythonSymbolNode
-        of Kind Ide.SymbolKind.PACKAGE.
+    def __init__(self, file: Gio.File, records: List[tuple]):
+        """Build the tree from the flat symbol records returned
+        by parsers.parse_symbols(), the tree's root is
+        a PythonSymbolNode of Kind Ide.SymbolKind.PACKAGE.
         """
         super().__init__()
-        gsettings = Gio.Settings(
-            schema="org.gnome.builder.plugins.python-symbols"
-        )
-
         self.root_node = PythonSymbolNode(
             line=0, col=0,
             name=Path(file.get_path()).name,
             kind=Ide.SymbolKind.PACKAGE,
             file=file
         )
-
-        parser = gsettings.get_string("symbol-parser")
-        if parser == "ast":
-            self.syntax_tree = AstSyntaxNode(
-                file,
-                xprt_impts=gsettings.get_boolean("export-imports"),
-                xprt_mod_var=gsettings.get_boolean("export-modules-variables"),
-                xprt_cls_var=gsettings.get_boolean("export-class-variables"),
-            )
-        elif parser == "parso":
-            self.syntax_tree = ParsoSyntaxNode(
-                file,
-                xprt_impts=gsettings.get_boolean("export-imports"),
-                xprt_mod_var=gsettings.get_boolean("export-modules-variables"),
-                xprt_cls_var=gsettings.get_boolean("export-class-variables"),
-            )
-        else:
-            raise SyntaxNodeError(f"{parser} not a SyntaxParser")
-
-        log.debug(self.syntax_tree.dump())
-        for syntax_node in self.syntax_tree.iter_child_nodes():
-            self._visit_syntax_node(syntax_node, self.root_node, file)
-
-    @classmethod
-    def _visit_syntax_node(
-        cls, syntax_node: SyntaxNode,
-        parent: PythonSymbolNode,
-        file: Gio.File,
-    ) -> None:
-        """Visit the AST 'node'.
-
-        If the type of node is of interest (function, class, etc...)
-        fill the SymbolNode parent's children list with a new instance
-        of SymbolNode. Call visit_ast_node recursivly on children.
-        """
-        symbole_node = None
-        kind = syntax_node.get_kind()
-        if kind:
-            symbole_node = PythonSymbolNode(
-                line=syntax_node.get_line(),
-                col=syntax_node.get_col(),
-                kind=syntax_node.get_kind(),
-                name=syntax_node.get_name(),
-                file=file
-            )
-            parent.append(symbole_node)
-            for node in syntax_node.iter_child_nodes():
-                cls._visit_syntax_node(node, symbole_node, file)
-
-    @staticmethod
-    def _dump_syntax_tree(syntax_tree):
-        return syntax_tree.dump()
+        self.store = SymbolStore(records)
+        # symbol index -> indexes of its children, for expanded
+        # symbols, and symbol index -> PythonSymbolNode, for nodes
+        # handed to libide. The root node index is -1.
+        self._children = {}
+        self._nodes = {}
+
+    def _get_children(self, node: Optional[PythonSymbolNode]) -> List[int]:
+        index = -1 if node is None else node.index
+        children = self._children.get(index)
+        if children is None:
+            children = self._children[index] = self.store.get_children(index)
+        return children
 
     def do_get_n_children(self, node: Ide.SymbolNode) -> int:
         """Get the number of children of @node.
@@ -193,7 +386,7 @@ class PythonSymbolTree(GObject.Object, Ide.SymbolTree):
 
         Returns: An unsigned integer containing the number of children.
         """
-        return len(node) if node else len(self.root_node)
+        return len(self._get_children(node))
 
     def do_get_nth_child(
         self,
@@ -204,7 +397,22 @@ class PythonSymbolTree(GObject.Object, Ide.SymbolTree):
 
         Returns: an Ide.SymbolNode or None.
         """
-        return node[nth] if node else self.root_node[nth]
+        children = self._get_children(node)
+        if not 0 <= nth < len(children):
+            return None
+        index = children[nth]
+        child = self._nodes.get(index)
+        if child is None:
+            store = self.store
+            child = self._nodes[index] = PythonSymbolNode(
+                store.lines[index],
+                store.cols[index],
+                Ide.SymbolKind(store.kinds[index]),
+                store.names[index],
+                self.root_node.file,
+                index,
+            )
+        return child
 
     def get_root(self) -> PythonSymbolNode:
         """Returns the root node of this SymbolTree.
@@ -214,19 +422,36 @@ class PythonSymbolTree(GObject.Object, Ide.SymbolTree):
         return self.root_node
 
     def dump(self):
-        return self.root_node.dump()
+        lines = [repr(self.root_node)]
+        lines.extend(self.store.dump(indent=1))
+        return "\n".join(lines)
 
 
 class PythonSymbolProvider(Ide.Object, Ide.SymbolResolver):
     """PythonSymbolProvIder."""
 
-    # @debug
-    # def do_load(self) -> None:
-    #     pass
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # path -> (cache key, Future) of parses in progress
+        self._pending = {}
+
+    @debug
+    def do_load(self) -> None:
+        global _live_providers
+        _live_providers += 1
 
-    # @debug
-    # def do_unload(self) -> None:
-    #     pass
+    @debug
+    def do_unload(self) -> None:
+        global _live_providers
+        self._pending.clear()
+        # Builder creates a provider per python buffer, the tree
+        # cache and the worker processes are shared by all of them,
+        # let them go with the last one only.
+        _live_providers -= 1
+        if _live_providers <= 0:
+            _live_providers = 0
+            _tree_cache.clear()
+            reset_parse_pool()
 
     @debug
     def do_lookup_symbol_async(
@@ -318,11 +543,53 @@ class PythonSymbolProvider(Ide.Object, Ide.SymbolResolver):
         #     task.return_boolean(False)
         #     return
 
-        threading.Thread(
-            target=self._inspect_module,
-            args=(task, file),
-            name='python-symbols-thread'
-        ).start()
+        parser, exports, multiprocess = get_symbol_settings()
+        syntax_parser = SYNTAX_PARSERS.get(parser)
+        if syntax_parser is None:
+            task.return_error(GLib.Error(f"{parser} not a SyntaxParser"))
+            return
+
+        path = file.get_path()
+        try:
+            stat = os.stat(path)
+        except (OSError, TypeError) as err:  # missing or not a local file
+            task.return_error(GLib.Error(str(err)))
+            return
+        key = (
+            stat.st_mtime_ns, stat.st_size,
+            parser, tuple(exports.values())
+        )
+        cached = get_cached_tree(path, key)
+        if cached is not None:
+            task.symbol_tree = cached
+            task.return_boolean(True)
+            return
+
+        # requests come in bursts, share a parse already
+        # in progress for the same file in the same state.
+        pending = self._pending.get(path)
+        if pending is not None and pending[0] == key:
+            future = pending[1]
+        else:
+            try:
+                future = submit_parse(
+                    multiprocess, stat.st_size,
+                    syntax_parser, path, **exports
+                )
+            except BrokenProcessPool as err:
+                reset_parse_pool()
+                task.return_error(GLib.Error(str(err)))
+                return
+            self._pending[path] = (key, future)
+        # done callbacks run in the pool's management thread, get
+        # back to the task's main context to build the symbol tree.
+        future.add_done_callback(
+            lambda _future: invoke_in_context(
+                task.get_context(),
+                self._inspect_module,
+                task, file, key, _future
+            )
+        )
 
     def do_get_symbol_tree_finish(
         self, result: Gio.AsyncResult
@@ -335,19 +602,46 @@ class PythonSymbolProvider(Ide.Object, Ide.SymbolResolver):
         return None
 
     @debug
-    def _inspect_module(self, task: Gio.Task, file: Gio.File):
+    def _inspect_module(
+        self, task: Gio.Task,
+        file: Gio.File,
+        key: tuple,
+        future: Future,
+    ) -> bool:
+        path = file.get_path()
+        pending = self._pending.get(path)
+        if pending is not None and pending[1] is future:
+            del self._pending[path]
+        if task.return_error_if_cancelled():
+            return GLib.SOURCE_REMOVE
         try:
             context = self.get_context()
             if not context:
                 task.return_boolean(False)
-                return
-            task.symbol_tree = PythonSymbolTree(file)
+                return GLib.SOURCE_REMOVE
+            # could have been built by a request sharing the same parse
+            task.symbol_tree = get_cached_tree(path, key)
+            if task.symbol_tree is None:
+                records = future.result()
+                if isinstance(records, bytes):
+                    records = marshal.loads(records)
+                task.symbol_tree = PythonSymbolTree(file, records)
+                cache_tree(path, key, task.symbol_tree)
             # log.debug(f"{task.symbol_tree.dump()}")
         except SyntaxNodeError as err:
             log.exception("SyntaxNodeError")
             task.return_error(GLib.Error(str(err)))
+        except BrokenProcessPool as err:
+            log.exception("BrokenProcessPool")
+            reset_parse_pool()
+            task.return_error(GLib.Error(str(err)))
+        except Exception as err:
+            # never leave the task uncompleted
+            log.exception("Unexpected error")
+            task.return_error(GLib.Error(str(err)))
         else:
             task.return_boolean(True)
+        return GLib.SOURCE_REMOVE
 
 
 # class PythonCodeIndexEntries(GObject.Object, Ide.CodeIndexEntries):
@@ -90,6 +90,21 @@ class PythonSymbolsPreferencesAddin(GObject.Object, Ide.PreferencesAddin):
                 30
             )
         )
+        self._ids.append(
+            prefs.add_switch(
+                "python-plugins",
+                "python-symbols",
+                "org.gnome.builder.plugins.python-symbols",
+                "multiprocess-parsing",
+                None,
+                "true",
+                _("Parse large sources in worker processes"),
+                _("Parse large python sources in separate processes, "
+                  "using multiple cores."),
+                _("symbols python"),
+                35
+            )
+        )
 
         for index, parser in enumerate(["ast", "parso"]):
             self._ids.append(prefs.add_radio(